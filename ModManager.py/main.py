@@ -1,55 +1,101 @@
 #!/usr/bin/env python3
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import cached_property, lru_cache
 from pathlib import Path
 
 import argparse
-import json
-import modio
+import errno
+import orjson
 import os
-import requests
 import shutil
 import subprocess
+import threading
 import uuid
 import zipfile
 
 import configparser
 
-config = configparser.ConfigParser()
 pwd = Path(__file__).parent
 config_file = pwd / "config.ini"
-if not config_file.exists():
-    raise Exception("No configuration file found")
-config.read(str(config_file))
-
-can_download = False
-client = None
-
-if "mod.io" in config and "API_KEY" in config['mod.io']:
-    can_download = True
-    client = modio.ModioClient(api_key=config['mod.io']['API_KEY'])
-
-# Default cache dir
-cache_dir_str = "~/.mod.io"
-if "core" in config and "CACHE_DIR" in config['core']:
-    cache_dir_str = config['core']['CACHE_DIR']
-
-cache_dir = Path(os.path.expanduser(cache_dir_str))
-download_dir = cache_dir / "download"
-staging_dir_root = cache_dir / "staging"
-db_dir = cache_dir / "storage"
-profile_dir = cache_dir / "profiles"
+
+# Populated by _setup_paths
+cache_dir = None
+download_dir = None
+staging_dir_root = None
+db_dir = None
+profile_dir = None
+
 deployed_file_name = "deployed.txt"
 force_download = False
+download_chunk_size = 1024 * 1024
+extract_chunk_size = 1024 * 1024
+manifest_buffer_size = 1024 * 1024
+download_workers = 8
+print_lock = threading.Lock()
+
+
+@lru_cache(1)
+def _read_config():
+    if not config_file.exists():
+        raise Exception("No configuration file found")
+    config = configparser.ConfigParser()
+    config.read(str(config_file))
+    return config
+
+
+@lru_cache(1)
+def _setup_paths():
+    global cache_dir, download_dir, staging_dir_root, db_dir, profile_dir
+    config = _read_config()
+
+    # Default cache dir
+    cache_dir_str = "~/.mod.io"
+    if "core" in config and "CACHE_DIR" in config['core']:
+        cache_dir_str = config['core']['CACHE_DIR']
+
+    cache_dir = Path(os.path.expanduser(cache_dir_str))
+    download_dir = cache_dir / "download"
+    staging_dir_root = cache_dir / "staging"
+    db_dir = cache_dir / "storage"
+    profile_dir = cache_dir / "profiles"
+
+
+@lru_cache(1)
+def _setup():
+    """Creates the mod.io client, returning None if no API key is configured"""
+    config = _read_config()
+    if "mod.io" not in config or "API_KEY" not in config['mod.io']:
+        return None
+
+    # Imported here, as only the network operations need modio (and requests)
+    import modio
+    return modio.ModioClient(api_key=config['mod.io']['API_KEY'])
+
+
+def get_all_children(p: Path, rel: str = ""):
+    """Yields (path, relative path) for every file under p, with relative paths prefixed by rel"""
+    if not p.is_dir():
+        if p.is_file():
+            yield str(p), rel
+        return
 
+    stack = [(str(p), rel)]
+    while stack:
+        path, prefix = stack.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_rel = os.path.join(prefix, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, entry_rel))
+                elif entry.is_file():
+                    yield entry.path, entry_rel
 
-def get_all_children(p: Path):
-    if p.is_dir():
-        for c in p.iterdir():
-            yield from get_all_children(c)
 
-    if p.is_file():
-        yield p
+def log(*args, **kwargs):
+    with print_lock:
+        print(*args, **kwargs)
 
 
 def sizeof_fmt(num, suffix='B'):
@@ -68,20 +114,22 @@ def ask_for_confirmation(msg):
 
 
 def remove_empty_directories(path: Path, remove_root: bool = False):
-    """Function to remove empty folders"""
-    if not path.is_dir():
-        return
+    """Removes every empty folder under path, and path itself if remove_root is set and it ends up empty"""
+    root = str(path)
+    # Bottom-up, so children are removed before their parents are tried. rmdir
+    # refuses non-empty folders itself, so there is no need to list them first
+    for dirpath, _, _ in os.walk(root, topdown=False):
+        if dirpath == root and not remove_root:
+            continue
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            continue
+        print(f"Removing empty folder: {dirpath}")
 
-    # remove empty subfolders
-    files = path.iterdir()
-    for f in files:
-        remove_empty_directories(f, True)
 
-    # if folder empty, delete it
-    files = [x for x in path.iterdir()]
-    if len(files) == 0 and remove_root:
-        print(f"Removing empty folder: {path}")
-        os.rmdir(path)
+def profile_reference(file_name: str):
+    return file_name[:file_name.index(".")]
 
 
 class Profile(object):
@@ -101,9 +149,13 @@ class Profile(object):
     def __init__(self, path: Path):
         self.path = path
 
-        if path.exists():
-            text = path.read_text()
-            self.data = data = json.loads(text)
+        try:
+            data = orjson.loads(path.read_bytes())
+        except FileNotFoundError:
+            data = None
+
+        if data is not None:
+            self.data = data
             self.name = data['name']
             self.id = data['id']
             self.install_directory = data['install_directory']
@@ -118,11 +170,11 @@ class Profile(object):
 
     def write_to_file(self):
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.path.write_text(json.dumps(self.data, indent=2))
+        self.path.write_bytes(orjson.dumps(self.data, option=orjson.OPT_INDENT_2))
 
     @property
     def reference(self):
-        return self.path.name[:self.path.name.index(".")]
+        return profile_reference(self.path.name)
 
     @property
     def is_valid(self):
@@ -132,38 +184,42 @@ class Profile(object):
     def mods(self):
         return self.mod_dict.items()
 
-    @property
+    @cached_property
     def download_dir(self):
         d = download_dir / self.name
         d.mkdir(parents=True, exist_ok=True)
         return d
 
-    @property
+    @cached_property
     def staging_dir(self):
         d = staging_dir_root / str(self.id)
         d.mkdir(parents=True, exist_ok=True)
         return d
 
-    @property
+    @cached_property
     def deployed_file_manifest(self):
         return self.db_dir / deployed_file_name
 
-    @property
+    @cached_property
     def db_dir(self):
         d = db_dir / self.uuid
         d.mkdir(parents=True, exist_ok=True)
         return d
 
-    @property
+    @cached_property
     def patch_dir(self):
         d = self.db_dir / "patches"
         d.mkdir(parents=True, exist_ok=True)
         return d
 
-    @property
+    @cached_property
     def install_path(self):
         return Path(self.install_directory)
 
+    def ensure_dirs(self):
+        # Each directory property creates its directory the first time it is accessed
+        return self.download_dir, self.staging_dir, self.db_dir, self.patch_dir
+
     def generate_uuid(self):
         id = str(uuid.uuid4())
         self.data['uuid'] = id
@@ -171,20 +227,25 @@ class Profile(object):
         self.write_to_file()
         return id
 
+    @cached_property
+    def _display(self):
+        return f"{self.name} [{self.id}, {self.install_directory}], mods: {len(self.mod_dict)}"
+
     def __str__(self):
-        return f"{self.name} [{self.id}, {self.install_dir}], mods: {len(self.mods)}"
+        return self._display
 
 
-def download(url: str, file: Path):
-    with requests.get(url, stream=True) as r:
+def download(url: str, file: Path, session: "requests.Session"):
+    with session.get(url, stream=True) as r:
         r.raise_for_status()
+        # Copy straight off the raw stream rather than going through iter_content
+        r.raw.decode_content = True
         with file.open(mode='wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+            shutil.copyfileobj(r.raw, f, length=download_chunk_size)
 
 
-def try_download(profile: Profile, mod: modio.Mod, file: modio.File):
-    print(f"Trying to download {profile.name} / {mod.name} / {file.name}")
+def try_download(profile: Profile, mod: "modio.Mod", file: "modio.File", session: "requests.Session"):
+    log(f"Trying to download {profile.name} / {mod.name} / {file.name}")
 
     mod_dir = profile.download_dir / str(mod.id)
     mod_dir.mkdir(parents=True, exist_ok=True)
@@ -192,48 +253,53 @@ def try_download(profile: Profile, mod: modio.Mod, file: modio.File):
     file_loc = mod_dir / file.name
     if file_loc.exists():
         if file_loc.stat().st_mtime >= file.timestamp and not force_download:
-            print("  > Not downloading, remote file is older than the local")
+            log("  > Not downloading, remote file is older than the local")
             return False
         file_loc.unlink()
-    download(file.download_url, file_loc)
+    download(file.download_url, file_loc, session)
     fmt = sizeof_fmt(file_loc.stat().st_size)
-    print(f"  > Successfully downloaded {fmt[0]} byte{'s' if fmt[1] != 1 else ''} to {str(file_loc)}")
+    log(f"  > Successfully downloaded {fmt[0]} byte{'s' if fmt[1] != 1 else ''} to {str(file_loc)}")
     return file_loc
 
 
 def get_latest_file(directory: Path):
-    print(f"[DEBUG] Getting latest file in {directory}")
-    latest_child = None
-    for child in directory.iterdir():
-        print(f"[DEBUG]   Testing {child}")
-        if latest_child:
-            if child.stat().st_mtime > latest_child.stat().st_mtime:
-                print(f"[DEBUG]     {child} is now the latest child")
-                latest_child = child
-        else:
-            print(f"[DEBUG]     First {child}")
-            latest_child = child
-    return latest_child
+    with os.scandir(directory) as it:
+        latest_child = max(it, key=lambda e: e.stat().st_mtime, default=None)
+    return Path(latest_child.path) if latest_child else None
 
 
 def run_download(profile: Profile):
-    if not can_download:
+    client = _setup()
+    if client is None:
         print(f"No API key provided, downloads cannot be performed")
         return
     print(f"Updating {profile.name}")
-    for mod_name, mod_id in profile.mods:
-        print(f"Updating {mod_name}")
-        mod = client.get_mod(profile.id, mod_id)
-        file = mod.get_latest_file()
-        try_download(profile, mod, file)
+    mods = list(profile.mods)
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        futures = [executor.submit(update_mod, client, profile, mod_name, mod_id) for mod_name, mod_id in mods]
+        for future in futures:
+            future.result()
+
 
+def update_mod(client: "modio.ModioClient", profile: Profile, mod_name: str, mod_id: int):
+    log(f"Updating {mod_name}")
+    mod = client.get_mod(profile.id, mod_id)
+    file = mod.get_latest_file()
+    if file is None:
+        log(f"  > {mod_name} has no files to download")
+        return False
+    # The client's session is per-thread, so the download reuses this worker's connection pool
+    return try_download(profile, mod, file, client.session)
 
-def cleanup_file(installed_dir: Path, manifest_line: str):
+
+def cleanup_file(installed_dir: str, manifest_line: str):
     print(manifest_line)
-    deployed_file = installed_dir / manifest_line
-    if deployed_file.exists() and deployed_file.is_file():
-        print(f" - Removing {str(deployed_file)}")
-        deployed_file.unlink()
+    deployed_file = os.path.join(installed_dir, manifest_line)
+    try:
+        os.unlink(deployed_file)
+    except (FileNotFoundError, IsADirectoryError):
+        return
+    print(f" - Removed {deployed_file}")
 
 
 def cleanup_patch(profile: Profile, installed_dir: Path, manifest_line: str):
@@ -271,7 +337,8 @@ def cleanup(profile: Profile):
     if not deployed_file_manifest.exists():
         print("Found no deployment metadata, cannot perform cleanup")
         return
-    installed_dir = profile.install_path
+    installed_dir = str(profile.install_path)
+    mod_roots = set()
     text = deployed_file_manifest.read_text()
     for line in text.splitlines():
         if ":" not in line:
@@ -283,60 +350,94 @@ def cleanup(profile: Profile):
 
         if prefix == "FILE":
             cleanup_file(installed_dir, line)
+            path = os.path.normpath(line)
+            root = path.split(os.sep)[0]
+            if root != path and root not in (os.curdir, os.pardir):
+                mod_roots.add(root)
         elif prefix == "PATCH":
-            cleanup_patch(profile, installed_dir, line)
+            cleanup_patch(profile, Path(installed_dir), line)
 
-    remove_empty_directories(installed_dir, False)
+    # Sweep each mod's whole top-level directory, as mods can ship empty directories that never make it into the
+    # manifest
+    for root in mod_roots:
+        remove_empty_directories(Path(installed_dir) / root, True)
     deployed_file_manifest.unlink()
 
 
-def traverse_file_tree(root, current=None, callback=None, postorder=True, filter=None):
-    if callback is None:
-        # What's the point in traversing...
-        return
-
-    if current is None:
-        current = root
+def _copy_file(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            # Let the kernel copy the data, rather than bouncing it through userspace (Linux only)
+            remaining = os.fstat(fsrc.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except (AttributeError, OSError):
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, length=extract_chunk_size)
+    shutil.copystat(src, dst)
+
+
+def _move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        # Comparing st_dev up front isn't reliable (bind mounts share it), so only copy once the rename has failed.
+        # A hardlink can't cross devices either, so copy and drop the source
+        if e.errno != errno.EXDEV:
+            raise
+        _copy_file(src, dst)
+        os.unlink(src)
 
-    if not postorder:
-        if filter is None or filter(current):
-            callback(current)
 
-    if current.is_dir():
-        for child in current.iterdir():
-            traverse_file_tree(root, child, callback, postorder)
+def _write_manifest_line(manifest, line: str):
+    manifest.write(line.encode("utf-8"))
+    manifest.write(b"\n")
 
-    if postorder:
-        if filter is None or filter(current):
-            callback(current)
 
+def _rename_tree(root: Path, target_root: Path):
+    try:
+        os.rename(root, target_root)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        return False
+    return True
 
-def _deploy_root_dir(profile: Profile, root: Path, deployed_lines: list):
-    root_path = str(root.parent.resolve())
-    # for c in get_all_children(child):
-    #     path = str(c.resolve())[len(root_path) + 1:]
-    #     deployed_lines.append("FILE:" + path)
 
+def _deploy_root_dir(profile: Profile, root: Path, manifest):
     installed_dir = profile.install_path
 
-    def func(p: Path):
-        path_str = str(p.resolve())[len(root_path) + 1:]
+    # Nothing to merge or patch, so the whole tree can be renamed into place in one go
+    target_root = installed_dir / root.name
+    if not os.path.lexists(target_root):
+        os.makedirs(installed_dir, exist_ok=True)
+        if _rename_tree(root, target_root):
+            for _, path_str in get_all_children(target_root, root.name):
+                _write_manifest_line(manifest, f"FILE:{path_str}")
+            return
+
+    created_dirs = set()
+    for p, path_str in get_all_children(root, root.name):
         target_file = installed_dir / path_str
         if target_file.exists():
             # Handle patch generation/conversion
             if not target_file.name.endswith("cs"):
                 print(" - Unable to generate patch for non-recognised file type")
-                return
+                continue
             manifest_line = apply_patch(profile, p, target_file, path_str)
-            deployed_lines.append(f"PATCH:{manifest_line}")
+            _write_manifest_line(manifest, f"PATCH:{manifest_line}")
         else:
-            shutil.move(str(p.resolve()), str(target_file.resolve()))
-            deployed_lines.append(f"FILE:{path_str}")
-
-    traverse_file_tree(root, callback=func, filter=lambda x: x.is_file())
-
-    # target = installed_dir / child.name
-    # shutil.move(str(child), str(target))
+            # The mod's directories may not exist in the install directory yet
+            if target_file.parent not in created_dirs:
+                os.makedirs(target_file.parent, exist_ok=True)
+                created_dirs.add(target_file.parent)
+            _move_file(p, target_file)
+            _write_manifest_line(manifest, f"FILE:{path_str}")
 
 def deploy(profile: Profile):
     print(f"Deploying staged mods for {profile.name}")
@@ -347,27 +448,51 @@ def deploy(profile: Profile):
     if deployed_file.exists():
         cleanup(profile)
 
-    deployed_lines = []
-
-    for child in profile.staging_dir.iterdir():
-        print(f"  > Deploying {child}")
-        if child.suffix == ".dll":
-            deployed_lines.append(child.name)
-            target = installed_dir / child.name
-            shutil.move(str(child), str(target))
-        elif child.is_dir():
-            # TODO remove hard-coded prefix
-            if child.name == "Mods":
-                for c in child.iterdir():
-                    _deploy_root_dir(profile, c, deployed_lines)
+    staging_dir = profile.staging_dir
+
+    # The manifest is written as each file is deployed, rather than joined up at the end
+    print(f"  > Writing deployment manifest to {deployed_file}")
+    with open(deployed_file, "wb", buffering=manifest_buffer_size) as manifest:
+        for child in staging_dir.iterdir():
+            print(f"  > Deploying {child}")
+            if child.suffix == ".dll":
+                target = installed_dir / child.name
+                _move_file(child, target)
+                _write_manifest_line(manifest, child.name)
+            elif child.is_dir():
+                # TODO remove hard-coded prefix
+                if child.name == "Mods":
+                    for c in child.iterdir():
+                        _deploy_root_dir(profile, c, manifest)
+                else:
+                    _deploy_root_dir(profile, child, manifest)
             else:
-                _deploy_root_dir(profile, child, deployed_lines)
-        else:
-            print(f"    > Unsupported mod type: {child}")
+                print(f"    > Unsupported mod type: {child}")
+                continue
+
+
+def extract_zip(zip: zipfile.ZipFile, destination: Path):
+    root = os.path.abspath(destination)
+    directories = set()
+    files = []
+    for info in zip.infolist():
+        target = os.path.normpath(os.path.join(root, info.filename))
+        if not target.startswith(root + os.sep):
+            print(f"    > Skipping {info.filename}, it would be extracted outside of {root}")
             continue
+        if info.is_dir():
+            directories.add(target)
+        else:
+            directories.add(os.path.dirname(target))
+            files.append((info, target))
+
+    # Only create each directory once, rather than once per member
+    for d in directories:
+        os.makedirs(d, exist_ok=True)
 
-    print("  > Writing deployment manifest")
-    deployed_file.write_text("\n".join(deployed_lines))
+    for info, target in files:
+        with zip.open(info) as src, open(target, "wb") as dst:
+            shutil.copyfileobj(src, dst, length=extract_chunk_size)
 
 
 def stage(profile: Profile):
@@ -382,23 +507,25 @@ def stage(profile: Profile):
         if mod_file.suffix == ".zip":
             print(f"  > Staging {mod_name}")
             with zipfile.ZipFile(str(mod_file), "r") as zip:
-                zip.extractall(str(profile.staging_dir))
+                extract_zip(zip, profile.staging_dir)
         else:
             print(f"  > Mod {mod_name} is an unsupported file type [{mod_file}]")
 
 
 def run_profile(profile: Profile):
+    profile.ensure_dirs()
     cleanup(profile)
     run_download(profile)
     stage(profile)
     deploy(profile)
 
 
-def get_profiles():
+def iter_profile_paths():
     global profile_dir
-    for child in profile_dir.iterdir():
-        if child.name.endswith(".json"):
-            yield Profile(child)
+    with os.scandir(profile_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".json") and entry.is_file(follow_symlinks=False):
+                yield profile_reference(entry.name), Path(entry.path)
 
 
 def do():
@@ -434,11 +561,12 @@ def do():
     parser.add_argument("profiles", type=str, nargs="*", help="The profiles to process")
 
     args = parser.parse_args()
+    _setup_paths()
 
     if args.list:
         print(f"Profiles:")
-        for profile in get_profiles():
-            print(f" - {profile.reference}")
+        for reference, _ in iter_profile_paths():
+            print(f" - {reference}")
         return
 
     if args.cache_dir:
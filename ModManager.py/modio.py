@@ -1,4 +1,19 @@
+import orjson
 import requests
+import threading
+from requests.adapters import HTTPAdapter
+
+
+def create_session():
+    """
+    Creates a session with a pooled adapter. Sessions aren't documented as thread-safe, so each thread should create
+    its own
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
 class ModioClient(object):
@@ -14,6 +29,14 @@ class ModioClient(object):
 
     def __init__(self, api_key):
         self.api_key = api_key
+        self._thread_data = threading.local()
+
+    @property
+    def session(self):
+        # One session per thread, as the client is shared between the download workers
+        if not hasattr(self._thread_data, "session"):
+            self._thread_data.session = create_session()
+        return self._thread_data.session
 
     def get_games(self, filter: str = None):
         return self._request("/games", filter=filter, ret_type=Game, decompose=True)
@@ -46,13 +69,14 @@ class ModioClient(object):
         params['api_key'] = self.api_key
         url = self.BASE_URL + path
         if filter:
-            s = filter.split("=")
-            params[s[0]] = s[1]
+            for f in filter.split("&"):
+                s = f.split("=", 1)
+                params[s[0]] = s[1]
 
         # Client.__debug_url(url, params)
 
-        r = requests.get(url, params=params, headers=self.HEADERS)
-        data = r.json()
+        r = self.session.get(url, params=params, headers=self.HEADERS)
+        data = orjson.loads(r.content)
 
         if ret_type:
             if decompose:
@@ -71,8 +95,11 @@ class ModioClient(object):
 
 
 class ModioObject(object):
-    def __init__(self, client: ModioClient):
+    __slots__ = ('client', 'data')
+
+    def __init__(self, client: ModioClient, data):
         self.client = client
+        self.data = data
 
     @property
     def id(self):
@@ -90,9 +117,7 @@ class ModioObject(object):
 
 
 class Game(ModioObject):
-    def __init__(self, client: ModioClient, data):
-        super().__init__(client)
-        self.data = data
+    __slots__ = ()
 
     def get_mods(self):
         return self.client.get_mods(self.id)
@@ -102,9 +127,7 @@ class Game(ModioObject):
 
 
 class Mod(ModioObject):
-    def __init__(self, client: ModioClient, data):
-        super().__init__(client)
-        self.data = data
+    __slots__ = ()
 
     @property
     def game_id(self):
@@ -117,19 +140,23 @@ class Mod(ModioObject):
         return self.client.get_file(self.game_id, self.id, file_id)
 
     def get_latest_file(self):
-        files = self.get_files()
-        files.sort(key=lambda x: -x.timestamp)
-        return files[0]
+        # Let the server do the sorting, so only the latest file comes back
+        files = self.client.get_files(self.game_id, self.id, filter="_sort=-date_added&_limit=1")
+        return files[0] if files else None
 
 
 class File(ModioObject):
+    __slots__ = ('_name', '_timestamp', '_download_url')
+
     def __init__(self, client: ModioClient, data):
-        super().__init__(client)
-        self.data = data
+        super().__init__(client, data)
+        self._name = data['filename']
+        self._timestamp = data['date_added']
+        self._download_url = data['download']['binary_url']
 
     @property
     def name(self):
-        return self['filename']
+        return self._name
 
     @property
     def mod_id(self):
@@ -137,8 +164,8 @@ class File(ModioObject):
 
     @property
     def timestamp(self):
-        return self['date_added']
+        return self._timestamp
 
     @property
     def download_url(self):
-        return self['download']['binary_url']
+        return self._download_url